@@ -1,70 +1,307 @@
 import typing as T
-from time import sleep
+import asyncio
 import logging
+import math
+import os
+import random
+import time
 
+import httpx
+import orjson
 import pandas as pd
-import fmpsdk as fmp
 
-FMP_API_RETRIES = 2
-FMP_API_SLEEP_TIME = 70
+FMP_API_RETRIES = 5
+FMP_API_BACKOFF_BASE = 1
+FMP_API_BACKOFF_JITTER = 1
+FMP_API_RATE_LIMIT = 300
+FMP_API_RATE_PERIOD = 60
+FMP_API_CONCURRENCY = 64
+FMP_API_BATCH_SIZE = 5
 FMP_API_KEY = "yourkeyhere"
+FMP_API_URL = "https://financialmodelingprep.com/api/v3"
 FMP_DATE_FORMAT = "%Y-%m-%d"
+FMP_CACHE_ADJ_TOLERANCE = 1e-6
 
 
-def call_fmp(
-        method: T.Callable,
-        params: dict,
+class FMPError(Exception):
+    """Raised when FMP answers a request with an error message instead of data"""
+
+
+class TokenBucket:
+    """Token bucket shared by all requests to a host, refilled at `rate` tokens per `period` seconds. Throttling is pushed back by `defer` when the API reports its limit is exhausted."""
+
+    def __init__(self, rate: int = FMP_API_RATE_LIMIT, period: float = FMP_API_RATE_PERIOD):
+        self.capacity = rate
+        self.fill_rate = rate / period
+        self.tokens = float(rate)
+        self.updated_at = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(
+            self.capacity,
+            self.tokens + (now - self.updated_at) * self.fill_rate)
+        self.updated_at = now
+
+    async def acquire(self):
+        """Waits until a token is available and takes it"""
+        async with self.lock:
+            self._refill()
+            while self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) / self.fill_rate)
+                self._refill()
+            self.tokens -= 1
+
+    def defer(self, delay: float):
+        """Empties the bucket so no request is let through for `delay` seconds"""
+        self._refill()
+        self.tokens = min(self.tokens, -delay * self.fill_rate)
+
+
+def _rate_limit_reset(resp: httpx.Response) -> T.Optional[float]:
+    """Seconds until the rate limit resets as reported by the response headers, `None` if not reported"""
+    for header in ("X-RateLimit-Reset-After", "Retry-After"):
+        value = resp.headers.get(header)
+        if(value is not None):
+            try:
+                return float(value)
+            except ValueError:
+                pass
+    return None
+
+
+def _retry_delay(resp: T.Optional[httpx.Response], attempt: int) -> float:
+    """Seconds to wait before retrying; honors the rate-limit headers of a 429 response, otherwise backs off exponentially with jitter"""
+    if(resp is not None and resp.status_code == 429):
+        reset = _rate_limit_reset(resp)
+        if(reset is not None):
+            return reset
+    return FMP_API_BACKOFF_BASE * 2 ** attempt + random.uniform(0, FMP_API_BACKOFF_JITTER)
+
+
+def _is_retryable(error: Exception) -> bool:
+    """Whether a failed request may succeed on retry: transport errors, truncated or undecodable bodies, throttling and server errors may go away, other client errors (e.g. a bad API key) won't"""
+    if(isinstance(error, httpx.HTTPStatusError)):
+        status = error.response.status_code
+        return status == 429 or status >= 500
+    return isinstance(error, (httpx.TransportError, httpx.DecodingError, orjson.JSONDecodeError))
+
+
+def make_caller(
+        client: httpx.AsyncClient,
+        bucket: TokenBucket,
+        apikey: str = FMP_API_KEY,
         retries: int = FMP_API_RETRIES,
-        sleep_time: int = FMP_API_SLEEP_TIME
-):
-    """Calls an API method w/ params, if failed, sleeps for a given amount of time, tries again, and after a given number of retries still fails, raises an error. See: https://stackoverflow.com/a/23961254/10295948
+) -> T.Callable[..., T.Awaitable[T.Any]]:
+    """Creates `call_fmp`, bound once per ingestion to the client, rate limiter and API key. `call_fmp(endpoint, **params)` calls an API endpoint w/ params, if failed transiently (see `_is_retryable`), backs off, tries again, and after a given number of retries still fails, raises an error; other failures are raised right away. Requests are paced by `bucket`; on HTTP 429 the whole bucket is held back for the period reported by FMP.
     Parameters
     ----------
-    method : `typing.Callable`
-        API method
-    params : `dict`
-        Params to pass to method
+    client : `httpx.AsyncClient`
+        Client whose pooled connection is used to issue requests
+    bucket : `TokenBucket`
+        Rate limiter shared by all requests to FMP
+    apikey : `str`, optional
+        FMP API key, by default `settings.FMP_API_KEY`
     retries : `int`, optional
         Number of retries, by default `settings.FMP_API_RETRIES`
-    sleep_time : `int`, optional
-        Number of seconds to sleep after each retry, by default `settings.FMP_API_SLEEP_TIME`
     Raises
     ------
-    `Exception`
-        If request still fails after max retries
+    `httpx.HTTPError`, `orjson.JSONDecodeError`
+        From `call_fmp`, if request fails with a non-retryable error or still fails after max retries
     """
-    if(not params.get("apikey", None)):
-        params["apikey"] = FMP_API_KEY
+    async def call_fmp(endpoint: str, **params):
+        params["apikey"] = apikey
+        url = f"{FMP_API_URL}/{endpoint}"
+        attempt = 0
+        while attempt < retries:
+            await bucket.acquire()
+            resp = None
+            try:
+                resp = await client.get(url, params=params)
+                reset = _rate_limit_reset(resp)
+                if(reset is not None and resp.headers.get("X-RateLimit-Remaining") == "0"):
+                    bucket.defer(reset)
+                resp.raise_for_status()
+                # parse raw bytes with orjson, skipping text decoding and stdlib json
+                return orjson.loads(resp.content)
+            except (httpx.HTTPError, orjson.JSONDecodeError) as str_error:
+                # the error text carries the full URL, apikey included, so it isn't logged
+                status = resp.status_code if resp is not None else None
+                logging.error(
+                    f"FMP Request failed. {str_error.__class__.__name__} (status {status}) for {endpoint}")
+                attempt += 1
+                if(attempt >= retries or not _is_retryable(str_error)):
+                    raise
+                delay = _retry_delay(resp, attempt - 1)
+                if(resp is not None and resp.status_code == 429):
+                    bucket.defer(delay)
+                await asyncio.sleep(delay)
 
-    for x in range(0, retries):
-        try:
-            res = method(**params)
-            str_error = None
-        except Exception as str_error:
-            logging.error(f"FMP Request failed. {str(str_error)}")
-            pass
+    return call_fmp
 
-        if str_error:
-            if(x < retries):
-                sleep(sleep_time)
-            else:
-                raise str_error
-        else:
-            break
 
-    return res
+RawPriceHistory = T.Dict[str, T.List[T.Dict]]
 
 
-RawPriceHistory = T.Dict[str, T.List[T.Dict]]
+async def _fetch(
+    call_fmp: T.Callable[..., T.Awaitable[T.Any]],
+    sem: asyncio.Semaphore,
+    symbols: T.List[str],
+    start_str: str,
+    end_str: str,
+) -> RawPriceHistory:
+    """Fetches price action history of up to `FMP_API_BATCH_SIZE` symbols in a single request, waiting on `sem` so at most `FMP_API_CONCURRENCY` requests are in flight. Raises `FMPError` if FMP responds with an error message."""
+    async with sem:
+        res = await call_fmp(
+            f"historical-price-full/{','.join(symbols)}", **{"from": start_str, "to": end_str})
+
+    # FMP reports an invalid key or a reached limit in the body
+    if(res and "Error Message" in res):
+        raise FMPError(f"FMP Request failed. {res['Error Message']}")
+
+    # FMP only wraps the response in a list when more than one symbol is requested
+    stock_list = res.get("historicalStockList", [res]) if res else []
+    hist = {stock["symbol"]: stock["historical"]
+            for stock in stock_list if stock.get("historical")}
+
+    # results are keyed by the symbol FMP echoes back, which may not match the one requested
+    missing = [symbol for symbol in symbols if symbol not in hist]
+    if(missing):
+        logging.warning(f"FMP returned no price history for {', '.join(missing)}")
+    return hist
+
+
+async def _fetch_all(
+    call_fmp: T.Callable[..., T.Awaitable[T.Any]],
+    sem: asyncio.Semaphore,
+    ranges: T.Dict[str, T.Tuple[str, str]],
+    show_progress: bool,
+) -> RawPriceHistory:
+    """Fetches each symbol's price action history over its date range, batching symbols that share a range into one request and logging progress as batches complete"""
+    by_range = {}
+    for symbol, date_range in ranges.items():
+        by_range.setdefault(date_range, []).append(symbol)
+    batches = [
+        (date_range, batch[i:i + FMP_API_BATCH_SIZE])
+        for date_range, batch in by_range.items()
+        for i in range(0, len(batch), FMP_API_BATCH_SIZE)]
 
+    responses = {}
+    fetches = [_fetch(call_fmp, sem, batch, *date_range)
+               for date_range, batch in batches]
+    for ix, fetch in enumerate(asyncio.as_completed(fetches), 1):
+        responses.update(await fetch)
+        show_progress and logging.info(f"{ix}/{len(batches)}")
+    return responses
 
-def get_stocks_history(
+
+# cached raw price action history and the (start, end) date range it covers
+CachedHistory = T.Tuple[pd.DataFrame, T.Tuple[str, str]]
+
+
+def _cache_path(cache_dir: str, symbol: str) -> str:
+    return os.path.join(cache_dir, f"{symbol}.parquet")
+
+
+def _coverage_path(cache_dir: str, symbol: str) -> str:
+    return os.path.join(cache_dir, f"{symbol}.json")
+
+
+def _read_cache(cache_dir: str, symbol: str) -> T.Optional[CachedHistory]:
+    """Reads the raw price action history cached for a symbol along with the date range it was requested for, `None` if there's none"""
+    path = _cache_path(cache_dir, symbol)
+    coverage_path = _coverage_path(cache_dir, symbol)
+    if(not os.path.exists(path) or not os.path.exists(coverage_path)):
+        return None
+    with open(coverage_path, "rb") as f:
+        coverage = orjson.loads(f.read())
+    return pd.read_parquet(path, engine="pyarrow"), (coverage["start"], coverage["end"])
+
+
+def _usable_cache(
+    cached: T.Optional[CachedHistory], start_str: str, end_str: str
+) -> T.Optional[CachedHistory]:
+    """Returns `cached` if it can be extended to cover `start_str` to `end_str`, `None` if the symbol has to be fetched in full: the cache was requested from a later start, or has no day up to `end_str` to continue from"""
+    if(cached is None):
+        return None
+    history, (covered_start, _) = cached
+    if(covered_start > start_str or not (history["date"] <= end_str).any()):
+        return None
+    return cached
+
+
+def _missing_range(
+    cached: T.Optional[CachedHistory], start_str: str, end_str: str
+) -> T.Tuple[str, str]:
+    """Date range to request from FMP given a usable cache (see `_usable_cache`). The range starts at the last cached day within `end_str`, so that day is refetched: it may have been a partial bar, and its adjClose tells whether FMP re-adjusted the symbol since (see `_cache_is_stale`)."""
+    if(cached is None):
+        return start_str, end_str
+    history, _ = cached
+    return history["date"][history["date"] <= end_str].max(), end_str
+
+
+def _cache_is_stale(
+    cached: T.Optional[CachedHistory], fetched: T.List[T.Dict], anchor: str
+) -> bool:
+    """Whether FMP re-adjusted a symbol's prices since they were cached, i.e. the freshly fetched adjClose of the `anchor` day no longer matches the cached one. FMP back-adjusts past prices after splits and dividends, so a stale cache mixes price bases and has to be refetched in full."""
+    if(cached is None):
+        return False
+    history, _ = cached
+    cached_row = history[history["date"] == anchor]
+    if(cached_row.empty):
+        return False
+
+    fresh = next((row for row in fetched if row.get("date") == anchor), None)
+    if(fresh is None or fresh.get("adjClose") is None):
+        return True
+    return not math.isclose(
+        fresh["adjClose"], cached_row["adjClose"].iloc[0], rel_tol=FMP_CACHE_ADJ_TOLERANCE)
+
+
+def _update_cache(
+    cache_dir: str,
+    symbol: str,
+    cached: T.Optional[CachedHistory],
+    fetched: T.List[T.Dict],
+    start_str: str,
+    end_str: str,
+) -> T.List[T.Dict]:
+    """Merges freshly fetched rows into a symbol's cache, rewrites it along with the date range it now covers, and returns the cached rows within the requested range"""
+    frames = [pd.DataFrame(fetched)] if fetched else []
+    if(cached is not None):
+        frames.append(cached[0])
+    if(not frames):
+        return []
+
+    # fetched rows continue the cached ones from their last day, so the ranges join up
+    if(cached is not None):
+        covered_start, covered_end = cached[1]
+        coverage = {"start": covered_start, "end": max(covered_end, end_str)}
+    else:
+        coverage = {"start": start_str, "end": end_str}
+
+    # fresh rows come first so they win over stale cached ones
+    merged = pd.concat(frames, ignore_index=True) \
+        .drop_duplicates(subset="date", keep="first") \
+        .sort_values("date", ascending=False)
+    merged.to_parquet(
+        _cache_path(cache_dir, symbol), engine="pyarrow", index=False)
+    with open(_coverage_path(cache_dir, symbol), "wb") as f:
+        f.write(orjson.dumps(coverage))
+
+    in_range = merged[(merged["date"] >= start_str) & (merged["date"] <= end_str)]
+    return in_range.to_dict("records")
+
+
+async def get_stocks_history(
     symbols: T.List[str],
     start: pd.Timestamp,
     end: pd.Timestamp,
     show_progress: bool = True,
+    cache_dir: T.Optional[str] = None,
 ) -> RawPriceHistory:
-    """Fetches data for a list of symbols from FMP API
+    """Fetches data for a list of symbols from FMP API concurrently. If `cache_dir` is passed, responses are cached there as one parquet file per symbol, next to the date range it was requested for, and only dates from the last cached day on are requested. A symbol is refetched in full if its cache was requested from a later start than `start`, or FMP re-adjusted its prices since they were cached.
     Parameters
     ----------
     symbols : `T.List[str]`
@@ -75,23 +312,46 @@ def get_stocks_history(
         Start date for fetching data; overries `period` if passed, by default `None`
     end: `pd.Timestamp`, optional
         End date for fetching data, by default `pd.Timestamp.now(tz="UTC")`
+    cache_dir: `str`, optional
+        Directory to cache raw price action history in, by default `None`
     Returns
     -------
     `RawPriceHistory`
     """
     end_str = end.strftime(FMP_DATE_FORMAT)
     start_str = start.strftime(FMP_DATE_FORMAT)
+    cached = {symbol: _usable_cache(_read_cache(cache_dir, symbol), start_str, end_str)
+              for symbol in symbols} if cache_dir else {}
+    ranges = {symbol: _missing_range(cached.get(symbol), start_str, end_str)
+              for symbol in symbols}
+
+    bucket = TokenBucket()
+    sem = asyncio.Semaphore(FMP_API_CONCURRENCY)
+    # one HTTP/2 connection multiplexes all requests, saving a TLS handshake per request
+    limits = httpx.Limits(
+        max_connections=FMP_API_CONCURRENCY,
+        max_keepalive_connections=FMP_API_CONCURRENCY)
+    async with httpx.AsyncClient(http2=True, limits=limits) as client:
+        call_fmp = make_caller(client, bucket)
+        responses = await _fetch_all(call_fmp, sem, ranges, show_progress)
+
+        # refetch the whole range of symbols FMP re-adjusted since they were cached
+        stale = {
+            symbol: (start_str, end_str) for symbol, (fetch_from, _) in ranges.items()
+            if _cache_is_stale(cached.get(symbol), responses.get(symbol, []), fetch_from)}
+        for symbol in stale:
+            cached[symbol] = None
+            responses.pop(symbol, None)
+        responses.update(await _fetch_all(call_fmp, sem, stale, show_progress))
+
     hist = {}
-    for ix, symbol in enumerate(symbols):
-        show_progress and logging.info(f"{ix}/{len(symbols)}")
-        params = {
-            "from_date": start_str,
-            "to_date": end_str,
-            "symbol": symbol}
-        price_history: T.Dict = call_fmp(fmp.historical_price_full, params)
+    for symbol in symbols:
+        price_history: T.List[T.Dict] = responses.get(symbol, [])
+        if(cache_dir):
+            price_history = _update_cache(
+                cache_dir, symbol, cached[symbol], price_history, start_str, end_str)
         if(not price_history):
             continue
-        price_history: T.List[T.Dict] = price_history["historical"]
         hist[symbol] = price_history
 
-    return hist
\ No newline at end of file
+    return hist
@@ -2,103 +2,124 @@
 
 
 import typing as T
+import asyncio
 from logbook import Logger
 
 import pandas as pd
 import numpy as np
 from zipline.utils.calendars import TradingCalendar
+from zipline.utils.paths import cache_path, ensure_directory
 
-from fmp import get_stocks_history
+from fmp import FMP_DATE_FORMAT, get_stocks_history
 
 log = Logger(__name__)
 
 RawPriceHistory = T.Dict[str, T.List[T.Dict]]
 
+# FMP fields to keep, mapped to bundle column names; adjClose is used as close
+FMP_PRICE_FIELDS = {
+    "date": "date",
+    "open": "open",
+    "high": "high",
+    "low": "low",
+    "adjClose": "close",
+    "volume": "volume",
+}
+# some assets in FMP don't have volume data
+FMP_PRICE_DEFAULTS = {"volume": 0}
+# dtypes of the preallocated columns; volume is float until NaNs are filled
+PRICE_DTYPES = {
+    "date": object,
+    "open": "float64",
+    "high": "float64",
+    "low": "float64",
+    "close": "float64",
+    "volume": "float64",
+}
+# float32 holds prices exactly to the thousandths the daily bar writer stores
+# only below 2**24 / 1000; above it, e.g. BRK-A, prices would be written wrong
+FLOAT32_EXACT_PRICE_LIMIT = 2 ** 24 / 1000
+# columns written by daily_bar_writer
+PRICE_COLUMNS = ["open", "high", "low", "close", "volume"]
+
 
 def gen_asset_metadata(
-    data: pd.DataFrame, show_progress: bool, exchange: str
+    data: pd.DataFrame, show_progress: bool, exchange: str, symbols: T.List[str]
 ) -> pd.DataFrame:
     if show_progress:
         log.info("Generating asset metadata.")
 
-    data = data.groupby(by="symbol").agg({"date": [np.min, np.max]})
-    data.reset_index(inplace=True)
-    data["start_date"] = data.date.amin
-    data["end_date"] = data.date.amax
-    del data["date"]
-    data.columns = data.columns.get_level_values(0)
-
-    data["exchange"] = exchange
-    data["auto_close_date"] = data["end_date"].values + pd.Timedelta(days=1)
-    return data
-
-
-def _format_price_history(
-    price_history: pd.DataFrame
-) -> pd.DataFrame:
-    # use adjClose
-    price_history["close"] = price_history["adjClose"]
-
-    # remove extra cols
-    cols_to_keep = ["open", "high", "low", "close", "volume"]
-    cols_to_remove = list(set(price_history.columns) - set(cols_to_keep))
-    price_history.drop(columns=cols_to_remove, inplace=True)
-
-    # some assets in FMP don't have volume data
-    if("volume" not in price_history.columns):
-        price_history["volume"] = 0
+    # one row per symbol in `symbols` order, so sids line up with the symbol map
+    meta = data.groupby("symbol", observed=True, sort=False)["date"].agg(
+        start_date="min", end_date="max").reindex(symbols) \
+        .rename_axis("symbol").reset_index()
+    # asset db writer expects plain string symbols
+    meta["symbol"] = meta["symbol"].astype(object)
 
-    return price_history
+    meta["exchange"] = exchange
+    meta["auto_close_date"] = meta["end_date"] + pd.Timedelta(days=1)
+    return meta
 
 
 def _set_dates_for_calendar(
         price_history: pd.DataFrame,
-        calendar: TradingCalendar,
-        start: pd.Timestamp,
-        end: pd.Timestamp,
-        symbol_map: pd.Series
+        sessions: pd.DatetimeIndex,
 ) -> pd.DataFrame:
-    """Sets price history dataframe date column vals based on zipline Trading Calendar and inserts `NaN` for missing dates to avoid `AssertionError` of missing sessions from zipline. See: https://github.com/quantopian/zipline/issues/2195#issuecomment-392933283"""
-    # get bundle calendar sessions
-    sessions = calendar.sessions_in_range(start, end)
-
-    # set multiindex to date and symbol
-    price_history.set_index(["date", "symbol"], inplace=True, drop=True)
-    price_history.sort_index(inplace=True, level="date")
-
-    # FMP sometimes returns a date twice for the same symbol
-    price_history = price_history[
-        ~price_history.index.duplicated(keep='first')]
-
-    indices = [(date, symbol) for date in sessions for symbol in symbol_map]
-    price_history = price_history.reindex(indices)
-
-    return price_history
+    """Sets a single symbol's date-indexed price history to zipline Trading Calendar sessions and inserts `NaN` for missing dates to avoid `AssertionError` of missing sessions from zipline. See: https://github.com/quantopian/zipline/issues/2195#issuecomment-392933283"""
+    return price_history.reindex(sessions)
 
 
 def convert_price_to_df(
         raw_price: RawPriceHistory,
 ) -> pd.DataFrame:
-    all_history = pd.DataFrame()
-
-    symbols = raw_price.keys()
-    for symbol in symbols:
+    symbols = list(raw_price.keys())
+    lengths = [len(raw_price[symbol]) for symbol in symbols]
+    total = sum(lengths)
+
+    # allocate each column once and fill it symbol by symbol, only reading the kept FMP fields
+    columns = {
+        col: np.empty(total, dtype=PRICE_DTYPES[col])
+        for col in FMP_PRICE_FIELDS.values()}
+    offset = 0
+    for symbol, length in zip(symbols, lengths):
         price_history = raw_price[symbol]
-        price_history_df = pd.DataFrame(price_history)
-        price_history_df["symbol"] = symbol
-        price_history_df["date"] = pd.to_datetime(
-            price_history_df.date).dt.tz_localize("UTC")
-        all_history = all_history.append(price_history_df)
+        for field, col in FMP_PRICE_FIELDS.items():
+            default = FMP_PRICE_DEFAULTS.get(field)
+            columns[col][offset:offset + length] = [
+                row.get(field, default) for row in price_history]
+        offset += length
+
+    all_history = pd.DataFrame(columns)
+    all_history["symbol"] = pd.Categorical.from_codes(
+        np.repeat(np.arange(len(symbols)), lengths), categories=symbols)
+    all_history["volume"] = all_history["volume"].fillna(0).astype("int64")
+    # halve the bytes moved through pandas when no price would lose precision
+    ohlc = ["open", "high", "low", "close"]
+    if(all_history[ohlc].max().max() < FLOAT32_EXACT_PRICE_LIMIT):
+        all_history = all_history.astype(
+            {col: "float32" for col in ohlc}, copy=False)
+    all_history["date"] = pd.to_datetime(
+        all_history["date"], format=FMP_DATE_FORMAT, utc=True, cache=True)
+
+    # FMP sometimes returns a date twice for the same symbol
+    all_history = all_history.drop_duplicates(
+        subset=["date", "symbol"], keep="first")
     return all_history
 
 
 def parse_pricing_and_vol(
     data: pd.DataFrame, calendar: TradingCalendar, start: pd.Timestamp, end: pd.Timestamp, symbol_map: pd.Series
 ):
-    data = _set_dates_for_calendar(data, calendar, start, end, symbol_map)
-    data = _format_price_history(data)
-    for asset_id, symbol in symbol_map.items():
-        yield asset_id, data.xs(symbol, level="symbol")
+    # get bundle calendar sessions
+    sessions = calendar.sessions_in_range(start, end)
+    # row positions per symbol, so each symbol's frame is only built when written
+    positions = data.groupby("symbol", observed=True, sort=False).indices
+    # project to the written columns once rather than per symbol
+    prices = data.loc[:, PRICE_COLUMNS]
+    prices.index = pd.DatetimeIndex(data["date"])
+    for asset_id, symbol in zip(symbol_map.index.to_numpy(), symbol_map.to_numpy()):
+        yield asset_id, _set_dates_for_calendar(
+            prices.take(positions[symbol]), sessions)
 
 
 def ingest_fmp(
@@ -124,13 +145,18 @@ def ingest_fmp(
     # fetch and process price data
     end = pd.Timestamp.now(tz="UTC")
     start = end - pd.Timedelta(days=period)
-    raw_data: RawPriceHistory = get_stocks_history(
-        stocks, start=start, end=end)
+    # cache raw responses across ingestions; output_dir is new on each run
+    cache_dir = cache_path(["fmp"], environ=environ)
+    ensure_directory(cache_dir)
+    raw_data: RawPriceHistory = asyncio.run(get_stocks_history(
+        stocks, start=start, end=end, cache_dir=cache_dir))
     raw_data_df: pd.DataFrame = convert_price_to_df(raw_data)
+    # only symbols FMP returned data for get a sid, rather than every stock requested
+    symbols = list(raw_data.keys())
 
     # write assets and exchanges
     asset_metadata = gen_asset_metadata(
-        raw_data_df[["symbol", "date"]], show_progress, exchange[0])
+        raw_data_df[["symbol", "date"]], show_progress, exchange[0], symbols)
     exchanges = pd.DataFrame(
         data=[exchange],
         columns=["exchange", "canonical_name", "country_code"],